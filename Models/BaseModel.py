@@ -5,6 +5,8 @@ from copy import deepcopy
 
 import torch
 import torcheval.metrics.metric
+from torch import nn
+from torch.nn.utils import fuse_conv_bn_eval
 from torch.optim.lr_scheduler import _LRScheduler
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -17,11 +19,53 @@ import mlflow
 log = logger.log
 
 
+def _autocast_dtype(device: torch.device) -> torch.dtype:
+    """
+    Pick reduced precision type for torch.autocast on given device,
+    float16 only on cuda where GradScaler guards it from underflow,
+    bfloat16 elsewhere since it keeps float32 range without scaling
+    """
+    return torch.float16 if device.type == "cuda" else torch.bfloat16
+
+
 class BaseModel(ABC):
 
     def save_model():
         pass
 
+    def fuse_conv_bn(model) -> nn.Module:
+        """
+        Build evaluation copy of model where every Conv2d directly
+        followed by BatchNorm2d is folded into single Conv2d,
+        copy is kept in channels last layout so 1x1 convs run as GEMMs
+
+        Copy is never compiled, so building it per validation call
+        doesn't trigger recompilation of the training model
+
+        Returns:
+            nn.Module: fused uncompiled copy of model in eval mode
+        """
+        fused = deepcopy(model)
+        # Compiled call is a closure over original module, deepcopy keeps
+        # it by reference, so drop it to actually run the copy (eagerly)
+        for module in fused.modules():
+            module._compiled_call_impl = None
+        fused.eval()
+        for module in fused.modules():
+            children = list(module.named_children())
+            for (conv_name, conv), (bn_name, bn) in zip(
+                children, children[1:]
+            ):
+                if isinstance(conv, nn.Conv2d) and isinstance(
+                    bn, nn.BatchNorm2d
+                ):
+                    setattr(module, conv_name, fuse_conv_bn_eval(conv, bn))
+                    setattr(module, bn_name, nn.Identity())
+        # Applied after fusion so new fused convs are covered as well
+        return fused.to(memory_format=torch.channels_last).requires_grad_(
+            False
+        )
+
     def validation_loop(
         model,
         loss_fn: _Loss,
@@ -29,18 +73,38 @@ class BaseModel(ABC):
         metric: torcheval.metrics.Metric,
         device: Optional[torch.device] = torch.device("mps"),
     ):
-        model.eval()
-        running_vloss = 0.0
-        with torch.no_grad():
+        model = model.fuse_conv_bn()
+        running_vloss = torch.zeros((), device=device)
+        # Collect whole epoch to update metric once
+        num_samples = len(valid_loader.dataset)
+        vpredictions = torch.empty(
+            num_samples, dtype=torch.long, device=device
+        )
+        vtargets = torch.empty_like(vpredictions)
+        offset = 0
+        with torch.inference_mode():
             for vbatch_indx, (vinputs, vlabels) in enumerate(valid_loader):
-                vinputs, vlabels = vinputs.to(device), vlabels.to(device)
-                voutputs = model(vinputs)
-                vloss = loss_fn(voutputs, vlabels)
+                vinputs = vinputs.to(
+                    device,
+                    memory_format=torch.channels_last,
+                    non_blocking=True,
+                )
+                vlabels = vlabels.to(device, non_blocking=True)
+                with torch.autocast(
+                    device_type=device.type, dtype=_autocast_dtype(device)
+                ):
+                    voutputs = model(vinputs)
+                    vloss = loss_fn(voutputs, vlabels)
 
-                voutputs = torch.max(voutputs, dim=1).indices
-                metric.update(voutputs, vlabels)
-                running_vloss += vloss
+                batch_size = vlabels.shape[0]
+                vpredictions[offset:offset + batch_size] = voutputs.argmax(
+                    dim=1
+                )
+                vtargets[offset:offset + batch_size] = vlabels
+                offset += batch_size
+                running_vloss += vloss.detach()
             avg_vloss = running_vloss / (vbatch_indx + 1)
+            metric.update(vpredictions[:offset], vtargets[:offset])
         valid_f1_score = metric.compute()
         return avg_vloss, valid_f1_score
 
@@ -100,34 +164,65 @@ class BaseModel(ABC):
         patience = 0
         best_model = best_model
         len_of_data = len(train_loader)
+        scaler = torch.amp.GradScaler(
+            device.type, enabled=_autocast_dtype(device) == torch.float16
+        )
+        # Side stream lets F1 update overlap with next batch on cuda
+        metric_stream = (
+            torch.cuda.Stream(device) if device.type == "cuda" else None
+        )
         for epoch in range(num_epochs):
             if patience == max_patience:
                 break
             model.train()
             loop = tqdm(
-                enumerate(train_loader), leave=False, total=len_of_data
+                enumerate(train_loader),
+                leave=False,
+                total=len_of_data,
+                mininterval=0.5,
             )
-            running_loss = 0.0
+            loop.set_description(f"Epoch [{epoch+1}/{num_epochs}]")
+            running_loss = torch.zeros((), device=device)
             for batch_indx, (input, labels) in loop:
-                input, labels = input.to(device), labels.to(device)
-                optimizer.zero_grad()
-                out = model(input)
-                loss = loss_fn(out, labels)
-                loss.backward()
+                input = input.to(
+                    device,
+                    memory_format=torch.channels_last,
+                    non_blocking=True,
+                )
+                labels = labels.to(device, non_blocking=True)
+                optimizer.zero_grad(set_to_none=True)
+                with torch.autocast(
+                    device_type=device.type, dtype=_autocast_dtype(device)
+                ):
+                    out = model(input)
+                    loss = loss_fn(out, labels)
+                scaler.scale(loss).backward()
+                scaler.step(optimizer)
+                scaler.update()
+
                 """
                 Equal to
-                torch.nn.functional.softmax(out, dim=1).max(dim=1).indices
+                torch.nn.functional.softmax(out, dim=1).argmax(dim=1)
                 """
-                out = torch.max(out, dim=1).indices
-                metric.update(out, labels)
-
-                optimizer.step()
+                out = out.detach().argmax(dim=1)
+                if metric_stream is not None:
+                    metric_stream.wait_stream(torch.cuda.current_stream())
+                    out.record_stream(metric_stream)
+                    labels.record_stream(metric_stream)
+                    with torch.cuda.stream(metric_stream):
+                        metric.update(out, labels)
+                else:
+                    metric.update(out, labels)
 
-                loop.set_description(f"Epoch [{epoch+1}/{num_epochs}]")
+                # .item() syncs with device, so refresh loss display rarely
+                if batch_indx % 20 == 0:
+                    loop.set_postfix(loss=loss.detach().item(), refresh=False)
 
-                running_loss += loss.item()
+                running_loss += loss.detach()
 
-            avg_loss = running_loss / (batch_indx + 1)
+            avg_loss = running_loss.item() / (batch_indx + 1)
+            if metric_stream is not None:
+                torch.cuda.current_stream().wait_stream(metric_stream)
             train_f1_score = metric.compute()
             metric.reset()
             if scheduler:
@@ -147,10 +242,13 @@ class BaseModel(ABC):
                 )
 
             # Evaluation phase
+            # Drop grads so fused copy doesn't duplicate them
+            optimizer.zero_grad(set_to_none=True)
             avg_vloss, valid_f1_score = self.validation_loop(
                 loss_fn=loss_fn,
                 valid_loader=valid_loader,
                 metric=metric,
+                device=device,
             )
             # Mlflow part
             mlflow.log_metrics(
@@ -1,10 +1,63 @@
-from typing import List, Optional
+from contextlib import contextmanager, nullcontext
+from typing import Optional, Tuple
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 import torch
 
 from models.BaseModel import BaseModel
 
 
+@contextmanager
+def _frozen_bn_stats(module: nn.Module):
+    """
+    Keep BatchNorm running stats unchanged inside the context,
+    momentum 0 still normalizes with batch stats but skips the update
+    """
+    batch_norms = [
+        m for m in module.modules() if isinstance(m, nn.BatchNorm2d)
+    ]
+    momenta = [bn.momentum for bn in batch_norms]
+    for bn in batch_norms:
+        bn.momentum = 0.0
+    try:
+        yield
+    finally:
+        for bn, momentum in zip(batch_norms, momenta):
+            bn.momentum = momentum
+
+
+def _checkpoint_layer(
+    layer: nn.Sequential, x: torch.Tensor, segments: int = 2
+) -> torch.Tensor:
+    """
+    Same as torch checkpoint_sequential, but recompute during backward
+    runs with frozen BatchNorm stats so they are updated once per step
+
+    Args:
+        layer (nn.Sequential): residual layer to run
+        x (torch.Tensor): input tensor
+        segments (int, optional): number of chunks. Defaults to 2.
+
+    Returns:
+        torch.Tensor: layer output
+    """
+    segment_size = -(-len(layer) // segments)
+    starts = list(range(0, len(layer), segment_size))
+    for start in starts[:-1]:
+        segment = layer[start:start + segment_size]
+        x = checkpoint(
+            segment,
+            x,
+            use_reentrant=False,
+            context_fn=lambda segment=segment: (
+                nullcontext(),
+                _frozen_bn_stats(segment),
+            ),
+        )
+    # Last segment output is needed right away, no point to checkpoint it
+    return layer[starts[-1]:](x)
+
+
 class ResNetDeepBlock(nn.Module):
     def __init__(
         self,
@@ -42,12 +95,12 @@ class ResNetDeepBlock(nn.Module):
             bias=False,
         )
         self.bn3 = nn.BatchNorm2d(intermediate_channels * self.expansion)
-        self.relu = nn.ReLU()
+        self.relu = nn.ReLU(inplace=True)
         self.identity_downsample = identity_downsample
         self.stride = stride
 
     def forward(self, x):
-        identity = x.clone()
+        identity = x
 
         x = self.conv1(x)
         x = self.bn1(x)
@@ -61,7 +114,7 @@ class ResNetDeepBlock(nn.Module):
         if self.identity_downsample is not None:
             identity = self.identity_downsample(identity)
 
-        x += identity
+        x = x + identity
         x = self.relu(x)
         return x
 
@@ -96,7 +149,7 @@ class ResNetBlock(nn.Module):
                 bias=False,
             ),
             nn.BatchNorm2d(out_channels),
-            nn.ReLU(),
+            nn.ReLU(inplace=True),
         )
         self.conv_block_2 = nn.Sequential(
             nn.Conv2d(
@@ -109,7 +162,7 @@ class ResNetBlock(nn.Module):
             ),
             nn.BatchNorm2d(out_channels),
         )
-        self.relu = nn.ReLU()
+        self.relu = nn.ReLU(inplace=True)
         self.identity_downscale = identity_downscale
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
@@ -122,14 +175,14 @@ class ResNetBlock(nn.Module):
         Returns:
             torch.Tensor: block output
         """
-        identity = x.clone()
+        identity = x
         x = self.conv_block_1(x)
         x = self.conv_block_2(x)
 
         if self.identity_downscale:
             identity = self.identity_downscale(identity)
 
-        x += identity
+        x = x + identity
         x = self.relu(x)
         return x
 
@@ -139,8 +192,11 @@ class ResNet(nn.Module, BaseModel):
         self,
         in_channels: int,
         num_classes: int,
-        layers: Optional[List] = [2, 2, 2, 2],
+        layers: Optional[Tuple[int, ...]] = (2, 2, 2, 2),
         block: ResNetBlock = ResNetBlock,
+        use_checkpoint: bool = False,
+        mean: Optional[torch.Tensor] = None,
+        std: Optional[torch.Tensor] = None,
     ) -> None:
         """
         Create ResNet architecture model
@@ -148,14 +204,28 @@ class ResNet(nn.Module, BaseModel):
         Args:
             in_channels (int): initial image number of channels
             num_classes (int): number of classes for classification
-            layers (Optional[List], optional):
-                List with numbers of layers for each residual block.
-                Defaults to [2, 2, 2, 2].
+            layers (Optional[Tuple[int, ...]], optional):
+                Tuple with numbers of layers for each residual block.
+                Defaults to (2, 2, 2, 2).
             block (ResNetBlock, optional):
                 Residual custom block. Defaults to ResNetBlock.
+            use_checkpoint (bool, optional):
+                Recompute activations of deep residual layers during
+                backward to save memory while training. Defaults to False.
+            mean (Optional[torch.Tensor], optional):
+                Per channel mean of dataset used to normalize input
+                on device. Defaults to None (no shift).
+            std (Optional[torch.Tensor], optional):
+                Per channel std of dataset used to normalize input
+                on device. Defaults to None (no scaling).
         """
         super().__init__()
         self.in_channels = 64
+        self.use_checkpoint = use_checkpoint
+        mean = torch.zeros(in_channels) if mean is None else mean
+        std = torch.ones(in_channels) if std is None else std
+        self.register_buffer("mean", torch.as_tensor(mean).view(1, -1, 1, 1))
+        self.register_buffer("std", torch.as_tensor(std).view(1, -1, 1, 1))
         self.initial_layers = nn.Sequential(
             nn.Conv2d(
                 in_channels=in_channels,
@@ -170,37 +240,38 @@ class ResNet(nn.Module, BaseModel):
             nn.ReLU(),
         )
 
+        deep = issubclass(block, ResNetDeepBlock)
         self.layer_64 = self.create_residual_layer(
             block=block,
             out_channels=64,
             num_residual_blocks=layers[0],
-            deep=(block.__name__ == "ResNetDeepBlock"),
+            deep=deep,
         )
         self.layer_128 = self.create_residual_layer(
             block=block,
             out_channels=128,
             num_residual_blocks=layers[1],
             stride=2,
-            deep=(block.__name__ == "ResNetDeepBlock"),
+            deep=deep,
         )
         self.layer_256 = self.create_residual_layer(
             block=block,
             out_channels=256,
             num_residual_blocks=layers[2],
             stride=2,
-            deep=(block.__name__ == "ResNetDeepBlock"),
+            deep=deep,
         )
         self.layer_512 = self.create_residual_layer(
             block=block,
             out_channels=512,
             num_residual_blocks=layers[3],
             stride=2,
-            deep=(block.__name__ == "ResNetDeepBlock"),
+            deep=deep,
         )
         self.global_avg_pool = nn.AdaptiveAvgPool2d((1, 1))
         # adapt if model structure changes
         self.fc = nn.Linear(
-            512 * 4 if (block.__name__ == "ResNetDeepBlock") else 512,
+            512 * 4 if deep else 512,
             num_classes,
         )
 
@@ -294,25 +365,33 @@ class ResNet(nn.Module, BaseModel):
         Returns:
             torch.Tensor: model output
         """
+        x = (x - self.mean) / self.std
         x = self.initial_layers(x)
         x = self.layer_64(x)
         x = self.layer_128(x)
-        x = self.layer_256(x)
-        x = self.layer_512(x)
+        if self.use_checkpoint and self.training:
+            x = _checkpoint_layer(self.layer_256, x)
+            x = _checkpoint_layer(self.layer_512, x)
+        else:
+            x = self.layer_256(x)
+            x = self.layer_512(x)
         x = self.global_avg_pool(x)
-        x = x.squeeze()
+        x = torch.flatten(x, 1)
         x = self.fc(x)
         return x
 
 
 if __name__ == "__main__":
     device = torch.device("mps")
-    model = ResNet(3, 36, [2, 2, 2, 2], ResNetBlock).to(device)
-    model_deep = ResNet(3, 36, [3, 4, 23, 3], ResNetDeepBlock).to(
-        device=device
-    )
-    test_tensor = torch.rand(size=(16, 3, 224, 224), device=device)
-    out = model(test_tensor)
-    out_deep = model_deep(test_tensor)
-    print(out.shape)
-    print(out_deep.shape)
+    test_tensor = torch.rand(size=(2, 3, 224, 224), device=device)
+    with torch.inference_mode():
+        model = ResNet(3, 36, (2, 2, 2, 2), ResNetBlock).to(device)
+        print(model(test_tensor).shape)
+        # free first model before building the deep one
+        del model
+        if device.type == "mps":
+            torch.mps.empty_cache()
+        model_deep = ResNet(3, 36, (3, 4, 23, 3), ResNetDeepBlock).to(
+            device=device
+        )
+        print(model_deep(test_tensor).shape)
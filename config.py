@@ -6,7 +6,8 @@ NUM_WORKERS = 2
 DATASET = "kbevzuk/fruits-vegetables-classification-modified"
 DATASET_DIR = PROJECT_DIR + "/datasets/"
 DATASET_NAME = "fruits_veg_dataset"
-RES_NET_CONFIG = [3, 4, 6, 3]
+RES_NET_CONFIG = (3, 4, 6, 3)
+RES_NET_USE_CHECKPOINT = False
 IMAGE_SIZE = (224, 224)
 IMAGE_NUMBER_CHANNELS = 3
 TRAINED_MODELS_DIRECTORY = PROJECT_DIR + "/models/resnet_storage"
@@ -1,12 +1,13 @@
 import gc
 import os
 import sys
+from copy import deepcopy
 from typing import Optional
 
 import pandas as pd
 import torch
+from torch.utils.data import DataLoader
 from torcheval.metrics import MulticlassF1Score
-from torchvision import transforms
 
 sys.path.append("./")
 import config
@@ -61,11 +62,12 @@ def main(
     num_workers: Optional[int] = config.NUM_WORKERS,
     dataset_name: Optional[str] = config.DATASET_NAME,
     image_number_channels: Optional[tuple] = config.IMAGE_NUMBER_CHANNELS,
-    resnet_config: Optional[list] = config.RES_NET_CONFIG,
+    resnet_config: Optional[tuple] = config.RES_NET_CONFIG,
     mlflow_exp_name: Optional[str] = config.MLFLOW_EXPERIMENT_NAME,
     learning_rate: Optional[float] = 0.1,
     number_of_epochs: Optional[int] = 2,
     is_scheduler: Optional[bool] = False,
+    use_checkpoint: Optional[bool] = config.RES_NET_USE_CHECKPOINT,
 ):
     """
     Wrapper around train_model function for CLI
@@ -92,8 +94,8 @@ def main(
         image_number_channels (tuple, optional):
             Number of channels for images in dataset, in majority cases 1 or 3.
             Defaults to config.IMAGE_NUMBER_CHANNELS.
-        resnet_config (list, optional):
-            List with values that represent number of skip connectin layers.
+        resnet_config (tuple, optional):
+            Tuple with values that represent number of skip connectin layers.
             Defaults to config.RES_NET_CONFIG.
         mlflow_exp_name (str, optional):
             Name of mlflow experiment to store model,
@@ -108,6 +110,10 @@ def main(
         is_scheduler (bool, optional):
             Do we need to use scheduler or not.
             Defaults to False.
+        use_checkpoint (bool, optional):
+            Use gradient checkpointing for deep residual layers,
+            trades extra compute for activation memory.
+            Defaults to config.RES_NET_USE_CHECKPOINT.
     """
     train_model(
         annotation_file_name,
@@ -121,7 +127,8 @@ def main(
         mlflow_exp_name,
         learning_rate,
         number_of_epochs,
-        is_scheduler
+        is_scheduler,
+        use_checkpoint=use_checkpoint,
     )
 
 
@@ -133,12 +140,13 @@ def train_model(
     num_workers: Optional[int] = config.NUM_WORKERS,
     dataset_name: Optional[str] = config.DATASET_NAME,
     image_number_channels: Optional[tuple] = config.IMAGE_NUMBER_CHANNELS,
-    resnet_config: Optional[list] = config.RES_NET_CONFIG,
+    resnet_config: Optional[tuple] = config.RES_NET_CONFIG,
     resnet_block: Optional[ResNetBlock or ResNetDeepBlock] = ResNetDeepBlock,
     mlflow_exp_name: Optional[str] = config.MLFLOW_EXPERIMENT_NAME,
     learning_rate: Optional[float] = 0.1,
     number_of_epochs: Optional[int] = 2,
     is_scheduler: Optional[bool] = False,
+    use_checkpoint: Optional[bool] = config.RES_NET_USE_CHECKPOINT,
 ):
     """
     Main script for processing dataset and model training
@@ -165,8 +173,8 @@ def train_model(
         image_number_channels (tuple, optional):
             Number of channels for images in dataset, in majority cases 1 or 3.
             Defaults to config.IMAGE_NUMBER_CHANNELS.
-        resnet_config (list, optional):
-            List with values that represent number of skip connectin layers.
+        resnet_config (tuple, optional):
+            Tuple with values that represent number of skip connectin layers.
             Defaults to config.RES_NET_CONFIG.
         mlflow_exp_name (str, optional):
             Name of mlflow experiment to store model,
@@ -181,61 +189,90 @@ def train_model(
         is_scheduler (bool, optional):
             Do we need to use scheduler or not.
             Defaults to False.
+        use_checkpoint (bool, optional):
+            Use gradient checkpointing for deep residual layers,
+            trades extra compute for activation memory.
+            Defaults to config.RES_NET_USE_CHECKPOINT.
     """
     log = logger.log
     device = torch.device("mps")
-    data = pd.read_parquet(config.DATA_DIR + config.ANNOTATION_FILE_NAME)
+    data = pd.read_parquet(data_dir + annotation_file_name)
     NUM_CLASSES = data["class_id"].nunique()
     train_data_placeholder = "train"
+    sampler = create_custom_sampler(
+        root_dir=data_dir,
+        labels=data.loc[
+            data["dataset_type"] == train_data_placeholder, "class_id"
+        ].tolist(),
+        train_data_placeholder=train_data_placeholder,
+    )
     datasets, data_loaders = create_dataset_and_dataloader(
         file_name=annotation_file_name,
         root_dir=data_dir,
         batch_size=batch_size,
         num_workers=num_workers,
+        sampler=sampler,
+        pin_memory=device.type == "cuda",
     )
-    if f"{dataset_name}.pt" not in os.listdir(dataset_dir):
+    stats_path = os.path.join(dataset_dir, f"{dataset_name}.pt")
+    if not os.path.exists(stats_path):
+        # Stats must come from unweighted data, not from the sampler
         mean, var, std = calculate_stat_of_input_dataset(
-            data_loaders[train_data_placeholder]
+            DataLoader(
+                datasets[train_data_placeholder],
+                batch_size=batch_size,
+                num_workers=num_workers,
+            ),
+            device=device,
         )
         collection = {"mean": mean, "var": var, "std": std}
-        torch.save(collection, dataset_dir + f"{dataset_name}.pt")
+        torch.save(collection, stats_path)
     else:
         log.info("Getting dataset stats from .pth file")
-        stat_data_tensors = torch.load(dataset_dir + f"{dataset_name}.pt")
+        stat_data_tensors = torch.load(stats_path)
         mean = stat_data_tensors["mean"]
         std = stat_data_tensors["std"]
-    sampler = create_custom_sampler(
-        root_dir=data_dir,
-        dataset=datasets.get(train_data_placeholder),
-        dataloader=data_loaders.get(train_data_placeholder),
-        train_data_placeholder=train_data_placeholder,
-    )
-    custom_transform = transforms.Compose(
-        [
-            transforms.ToTensor(),
-            transforms.Normalize(mean=mean, std=std),
-        ]
-    )
-
-    _, data_loaders = create_dataset_and_dataloader(
-        file_name=annotation_file_name,
-        root_dir=data_dir,
-        batch_size=batch_size,
-        transformation=custom_transform,
-        num_workers=num_workers,
-        sampler=sampler,
-    )
     gc.collect()
 
     model = ResNet(
         in_channels=image_number_channels,
         num_classes=NUM_CLASSES,
         layers=resnet_config,
-        block=resnet_block
+        block=resnet_block,
+        use_checkpoint=use_checkpoint,
+        mean=mean,
+        std=std,
     ).to(device)
+    # NHWC layout lets cuDNN pick Tensor Core friendly conv kernels
+    model = model.to(memory_format=torch.channels_last)
+    torch.backends.cudnn.benchmark = True
+    if device.type == "cuda":
+        # Compiled inplace so state_dict keys stay the same
+        model.compile(mode="reduce-overhead")
+        # Compilation is lazy, warm up on dummy batch to surface errors here
+        initial_state = deepcopy(model.state_dict())
+        try:
+            dummy_input = torch.rand(
+                batch_size,
+                image_number_channels,
+                *config.IMAGE_SIZE,
+                device=device,
+            ).to(memory_format=torch.channels_last)
+            with torch.autocast(device_type=device.type, dtype=torch.float16):
+                out = model(dummy_input)
+            out.float().sum().backward()
+        except Exception as e:
+            log.error(f"torch.compile failed, training in eager mode: {e}")
+            model._compiled_call_impl = None
+        finally:
+            # Warm up must not leak into BatchNorm stats or grads
+            model.load_state_dict(initial_state)
+            model.zero_grad(set_to_none=True)
 
     loss = torch.nn.CrossEntropyLoss()
-    optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
+    optimizer = torch.optim.Adam(
+        model.parameters(), lr=learning_rate, fused=device.type == "cuda"
+    )
     if is_scheduler:
         scheduler = torch.optim.lr_scheduler.ExponentialLR(
             optimizer, verbose=True, gamma=0.1
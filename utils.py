@@ -1,5 +1,5 @@
 import os
-from typing import Optional, Tuple
+from typing import Optional, Sequence, Tuple
 
 import torch
 import torchvision
@@ -16,31 +16,44 @@ log = logger.log
 
 def calculate_stat_of_input_dataset(
     dataloader: DataLoader,
-) -> Tuple[float, float, float]:
+    device: Optional[torch.device] = torch.device("cpu"),
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
     """
-    Calculates mean, variance and standart deviation of images dataset
+    Calculates per channel mean, variance and standart deviation
+    of images dataset in a single pass
 
     Args:
         dataloader: DataLoader
             Pytorch data loader with defined pytorch dataset
+        device: torch.device
+            Device where sums are accumulated, results are moved to cpu
 
     Returns:
-        Tuple[float, float, float]
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]
             Values for mean, variance and standart deviation of dataset
 
     """
     log.info("Calculating mean, std of dataset")
-    channel_sum, channel_sum_squared, num_batches = 0, 0, 0
-    for data, _ in tqdm(dataloader):
-        channel_sum += torch.mean(data, dim=[0, 2, 3])
-        channel_sum_squared += torch.mean(data**2, dim=[0, 2, 3])
-
-        num_batches += 1
-    total_mean = channel_sum / num_batches
-    total_var = channel_sum_squared / num_batches - total_mean**2
+    # mps has no float64 support
+    acc_dtype = torch.float32 if device.type == "mps" else torch.float64
+    channel_sum, channel_sum_squared, num_pixels = 0, 0, 0
+    with torch.inference_mode():
+        for data, _ in tqdm(dataloader):
+            data = data.to(device, non_blocking=True)
+            channel_sum += data.sum(dim=[0, 2, 3], dtype=acc_dtype)
+            channel_sum_squared += (data**2).sum(
+                dim=[0, 2, 3], dtype=acc_dtype
+            )
+            num_pixels += data.numel() // data.shape[1]
+    total_mean = channel_sum / num_pixels
+    total_var = channel_sum_squared / num_pixels - total_mean**2
     total_std = total_var**0.5
 
-    return total_mean, total_var, total_std
+    return (
+        total_mean.float().cpu(),
+        total_var.float().cpu(),
+        total_std.float().cpu(),
+    )
 
 
 def create_dataset_and_dataloader(
@@ -51,6 +64,9 @@ def create_dataset_and_dataloader(
     num_workers: Optional[int] = os.cpu_count(),
     sampler: Optional[_SamplerType] = None,
     shuffle: Optional[bool] = True,
+    pin_memory: Optional[bool] = False,
+    prefetch_factor: Optional[int] = 4,
+    persistent_workers: Optional[bool] = True,
 ) -> dict[str, DataLoader]:
     """
     Creating train, test and validation datasets
@@ -69,6 +85,14 @@ def create_dataset_and_dataloader(
             Sampler for imbalanced datasets
         shuffle: boot
             To have the data reshuffled at every epoch
+        pin_memory: bool
+            Copy batches into page-locked memory for async transfer to GPU
+        prefetch_factor: int
+            Number of batches loaded in advance by each worker,
+            ignored when num_workers is 0
+        persistent_workers: bool
+            Keep worker processes alive between epochs,
+            ignored when num_workers is 0
 
     Returns:
         Dict(str, DataLoader)
@@ -92,6 +116,9 @@ def create_dataset_and_dataloader(
             shuffle=shuffle if dataset != "train" else False,
             num_workers=num_workers,
             sampler=sampler if (sampler and dataset == "train") else None,
+            pin_memory=pin_memory,
+            prefetch_factor=prefetch_factor if num_workers else None,
+            persistent_workers=persistent_workers and bool(num_workers),
         )
         for dataset in datasets_types
     }
@@ -100,8 +127,7 @@ def create_dataset_and_dataloader(
 
 def create_custom_sampler(
     root_dir: str,
-    dataset: Fruits_and_vegetables_dataset,
-    dataloader: DataLoader,
+    labels: Sequence[int],
     train_data_placeholder: Optional[str] = "train",
 ) -> WeightedRandomSampler:
     """
@@ -111,10 +137,9 @@ def create_custom_sampler(
     Args:
         root_dir: str
             Root directory with data files
-        dataset: Fruits_and_vegetables_dataset
-            Custom dataset with train data created with function below
-        dataloader: DataLoader
-            DataLoader with train data
+        labels: Sequence[int]
+            Class ids of train samples in dataset order,
+            taken from annotations so no image has to be decoded
         train_data_placeholder: str
             Placeholder for os.walk proper search
 
@@ -127,18 +152,7 @@ def create_custom_sampler(
     for root, sub_dir, files in os.walk(root_dir + train_data_placeholder):
         if files:
             class_weights.append(1 / len(files))
-    sample_weights = [0] * len(dataset)
-    if dataloader.batch_size > 1:
-        indx = 0
-        for _, labels in dataloader:
-            for label in labels:
-                class_w = class_weights[label]
-                sample_weights[indx] = class_w
-                indx += 1
-    else:
-        for idx, (_, label) in enumerate(dataloader):
-            class_w = class_weights[label]
-            sample_weights[idx] = class_w
+    sample_weights = [class_weights[label] for label in labels]
     sampler = WeightedRandomSampler(
         sample_weights, num_samples=len(sample_weights), replacement=True
     )